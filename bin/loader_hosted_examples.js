@@ -7,7 +7,9 @@
  *
  * ol.css, ol.js, ol-simple.js, ol-whitespace.js, and ol-deps.js are built
  * by OL3's build.py script. They are located in the ../build/ directory,
- * relatively to this script.
+ * relatively to this script. With mode=modules the shared ol module and the
+ * example's module, from the multi-module examples build hosted by
+ * build.py's host-examples-modules target, are loaded instead.
  *
  * The script must be named loader.js.
  *
@@ -67,6 +69,12 @@
 
   var scriptId = encodeURIComponent(scriptParams.id);
   document.write('<link rel="stylesheet" href="../build/ol.css" type="text/css">');
+  if (mode == 'modules') {
+    // the shared ol module followed by the example's own compiled module
+    document.write('<scr' + 'ipt type="text/javascript" src="../build/modules/ol.js"></scr' + 'ipt>');
+    document.write('<scr' + 'ipt type="text/javascript" src="../build/modules/' + scriptId + '.js"></scr' + 'ipt>');
+    return;
+  }
   if (mode != 'raw') {
     document.write('<scr' + 'ipt type="text/javascript" src="../build/' + oljs + '"></scr' + 'ipt>');
   } else {
@@ -9,7 +9,8 @@ import re
 import shutil
 import sys
 
-from pake import Target, ifind, main, output, rule, target, variables, virtual
+from pake import Lazy, Service, Target, atomic_write, database, fingerprint, \
+    ifind, main, output, rule, scanner, target, variables, virtual
 
 
 if sys.platform == 'win32':
@@ -34,10 +35,13 @@ else:
     variables.PYTHON = 'python'
     variables.PHANTOMJS = 'phantomjs'
 
+variables.PLOVR_WORKER = ''
+variables.PLOVR_WORKER_PORT = '9811'
+
 TEMPLATE_GLSL_COMPILER_JS = 'build/glsl-unit/bin/template_glsl_compiler.js'
 
-variables.BRANCH = output(
-    '%(GIT)s', 'rev-parse', '--abbrev-ref', 'HEAD').strip()
+variables.BRANCH = Lazy(lambda: output(
+    '%(GIT)s', 'rev-parse', '--abbrev-ref', 'HEAD').strip())
 
 EXPORTS = [path
            for path in ifind('src')
@@ -70,6 +74,15 @@ EXAMPLES_JSON = ['build/' + example.replace('.html', '.json')
 EXAMPLES_COMBINED = ['build/' + example.replace('.html', '.combined.js')
                      for example in EXAMPLES]
 
+EXAMPLES_EXTERNS = [
+    '//json.js',
+    '//jquery-1.7.js',
+    '../externs/bingmaps.js',
+    '../externs/bootstrap.js',
+    '../externs/geojson.js',
+    '../externs/proj4js.js',
+    '../externs/tilejson.js']
+
 INTERNAL_SRC = [
     'build/src/internal/src/requireall.js',
     'build/src/internal/src/types.js']
@@ -93,19 +106,83 @@ SRC = [path
 PLOVR_JAR = 'build/plovr-eba786b34df9.jar'
 PLOVR_JAR_MD5 = '20eac8ccc4578676511cf7ccbfc65100'
 
+PLOVR_CONFIGS = [
+    'buildcfg/ol.json',
+    'buildcfg/ol-all.json',
+    'buildcfg/ol-simple.json',
+    'buildcfg/ol-whitespace.json'] + EXAMPLES_JSON
+
+PLOVR_WORKER = Service('plovr-worker', '%(PLOVR_WORKER_PORT)s')
+
+# Each plovr build starts a JVM, limit them with --resource jvm=N or
+# --resource mem=SIZE.  Example compiles and checks can also run on other
+# hosts started with ./build.py --serve-worker HOST:PORT and given with
+# --worker HOST:PORT=CAPACITY, both with the same PAKE_WORKER_TOKEN set in
+# the environment.
+PLOVR_RESOURCES = {'jvm': 1, 'mem': '1500M'}
+
+PHANTOMJS_RESOURCES = {'mem': '300M'}
+
 PROJ4JS = 'build/proj4js/lib/proj4js-combined.js'
 PROJ4JS_ZIP = 'build/proj4js-1.1.0.zip'
 PROJ4JS_ZIP_MD5 = '17caad64cf6ebc6e6fe62f292b134897'
 
 
+def plovr_build(t, config):
+    args = ('%(JAVA)s', '-jar', PLOVR_JAR, 'build', config)
+    if not variables.PLOVR_WORKER:
+        t.output(args)
+        return
+    # Compile in a long-lived plovr server so that the JVM start-up and the
+    # parsing of the Closure library are only paid once.  plovr only knows
+    # about the configs it was started with, so a config generated after
+    # the server started requires a restart.
+    server_args = PLOVR_WORKER.args
+    if server_args is None or config not in server_args:
+        server_args = ['%(JAVA)s', '-jar', PLOVR_JAR, 'serve',
+                       '--port', '%(PLOVR_WORKER_PORT)s',
+                       [c for c in PLOVR_CONFIGS if os.path.exists(c)]]
+
+    def write(f):
+        with PLOVR_WORKER.use(t, server_args,
+                              log='build/plovr-worker.log') as worker:
+            t.info('compile %s', config)
+            content = worker.request(
+                '/compile?id=' + plovr_config(config)['id'])
+        if 'plovr.addErrors(' in content:
+            t.error('compilation of %s failed, see build/plovr-worker.log' %
+                    (config,))
+        f.write(content)
+    t.produce(args, write)
+
+
+def plovr_config(path):
+    with open(path) as f:
+        # plovr allows // comments on lines of their own
+        return json.loads(re.sub(r'(?m)^\s*//.*$', '', f.read()))
+
+
+@scanner(r'\.json\Z')
+def plovr_config_inherits(path):
+    while True:
+        inherits = plovr_config(path).get('inherits')
+        if not inherits:
+            break
+        path = os.path.normpath(os.path.join(os.path.dirname(path), inherits))
+        yield path
+
+
 def report_sizes(t):
-    t.info('uncompressed: %d bytes', os.stat(t.name).st_size)
+    size = os.stat(t.name).st_size
+    t.info('uncompressed: %d bytes', size)
+    t.metric('size_bytes', size)
     stringio = StringIO()
     gzipfile = gzip.GzipFile(t.name, 'w', 9, stringio)
     with open(t.name) as f:
         shutil.copyfileobj(f, gzipfile)
     gzipfile.close()
     t.info('  compressed: %d bytes', len(stringio.getvalue()))
+    t.metric('size_bytes', len(stringio.getvalue()), compression='gzip')
 
 
 virtual('default', 'build')
@@ -131,25 +208,27 @@ def build_ol_css(t):
 
 
 @target('build/ol.js', PLOVR_JAR, SRC, EXTERNAL_SRC, SHADER_SRC,
-        'buildcfg/base.json', 'buildcfg/ol.json')
+        'buildcfg/base.json', 'buildcfg/ol.json', outputs=['build/ol.css'],
+        resources=PLOVR_RESOURCES)
 def build_ol_js(t):
+    # not compiled in the plovr worker, plovr build also writes build/ol.css
     t.output('%(JAVA)s', '-jar', PLOVR_JAR, 'build', 'buildcfg/ol.json')
     report_sizes(t)
 
 
 @target('build/ol-simple.js', PLOVR_JAR, SRC, INTERNAL_SRC, SHADER_SRC,
-        'buildcfg/base.json', 'buildcfg/ol.json', 'buildcfg/ol-simple.json')
+        'buildcfg/base.json', 'buildcfg/ol.json', 'buildcfg/ol-simple.json',
+        resources=PLOVR_RESOURCES)
 def build_ol_simple_js(t):
-    t.output('%(JAVA)s', '-jar', PLOVR_JAR, 'build', 'buildcfg/ol-simple.json')
+    plovr_build(t, 'buildcfg/ol-simple.json')
     report_sizes(t)
 
 
 @target('build/ol-whitespace.js', PLOVR_JAR, SRC, INTERNAL_SRC, SHADER_SRC,
         'buildcfg/base.json', 'buildcfg/ol.json',
-        'buildcfg/ol-whitespace.json')
+        'buildcfg/ol-whitespace.json', resources=PLOVR_RESOURCES)
 def build_ol_whitespace_js(t):
-    t.output('%(JAVA)s', '-jar', PLOVR_JAR,
-             'build', 'buildcfg/ol-whitespace.json')
+    plovr_build(t, 'buildcfg/ol-whitespace.json')
     report_sizes(t)
 
 
@@ -157,27 +236,28 @@ virtual('build-all', 'build/ol-all.js')
 
 
 @target('build/ol-all.js', PLOVR_JAR, SRC, INTERNAL_SRC, SHADER_SRC,
-        'buildcfg/base.json', 'buildcfg/ol-all.json')
+        'buildcfg/base.json', 'buildcfg/ol-all.json',
+        resources=PLOVR_RESOURCES)
 def build_ol_all_js(t):
-    t.output('%(JAVA)s', '-jar', PLOVR_JAR, 'build', 'buildcfg/ol-all.json')
+    plovr_build(t, 'buildcfg/ol-all.json')
 
 
 @target('build/src/external/externs/types.js', 'bin/generate-exports.py',
-        'src/objectliterals.exports')
+        'src/objectliterals.exports', restat=True)
 def build_src_external_externs_types_js(t):
     t.output('%(PYTHON)s', 'bin/generate-exports.py',
              '--externs', 'src/objectliterals.exports')
 
 
 @target('build/src/external/src/exports.js', 'bin/generate-exports.py',
-        'src/objectliterals.exports', EXPORTS)
+        'src/objectliterals.exports', EXPORTS, restat=True)
 def build_src_external_src_exports_js(t):
     t.output('%(PYTHON)s', 'bin/generate-exports.py',
              '--exports', 'src/objectliterals.exports', EXPORTS)
 
 
 @target('build/src/external/src/types.js', 'bin/generate-exports.py',
-        'src/objectliterals.exports')
+        'src/objectliterals.exports', restat=True)
 def build_src_external_src_types_js(t):
     t.output('%(PYTHON)s', 'bin/generate-exports.py',
              '--typedef', 'src/objectliterals.exports')
@@ -208,18 +288,19 @@ def _build_require_list(dependencies, output_file_name):
             f.write('goog.require(\'%s\');\n' % (require,))
 
 
-@target('build/src/internal/src/requireall.js', SRC, SHADER_SRC)
+@target('build/src/internal/src/requireall.js', SRC, SHADER_SRC,
+        restat=True)
 def build_src_internal_src_requireall_js(t):
     _build_require_list(t.dependencies, t.name)
 
 
-@target('build/test/requireall.js', SPEC)
+@target('build/test/requireall.js', SPEC, restat=True)
 def build_test_requireall_js(t):
     _build_require_list(t.dependencies, t.name)
 
 
 @target('build/src/internal/src/types.js', 'bin/generate-exports.py',
-        'src/objectliterals.exports')
+        'src/objectliterals.exports', restat=True)
 def build_src_internal_types_js(t):
     t.output('%(PYTHON)s', 'bin/generate-exports.py',
              '--typedef', 'src/objectliterals.exports')
@@ -236,7 +317,8 @@ def examples_examples_list_xml(t):
     t.touch()  # already generated by bin/exampleparser.py
 
 
-@target('examples/example-list.js', 'bin/exampleparser.py', EXAMPLES)
+@target('examples/example-list.js', 'bin/exampleparser.py', EXAMPLES,
+        restat=True)
 def examples_examples_list_js(t):
     t.run('%(PYTHON)s', 'bin/exampleparser.py', 'examples', 'examples')
 
@@ -251,33 +333,74 @@ def examples_star_json(name, match):
                 '../examples/%(id)s.js' % match.groupdict(),
                 '../build/src/internal/src/types.js',
             ],
-            'externs': [
-                '//json.js',
-                '//jquery-1.7.js',
-                '../externs/bingmaps.js',
-                '../externs/bootstrap.js',
-                '../externs/geojson.js',
-                '../externs/proj4js.js',
-                '../externs/tilejson.js',
-            ],
+            'externs': EXAMPLES_EXTERNS,
         })
         with open(t.name, 'w') as f:
             f.write(content)
     dependencies = [__file__, 'buildcfg/base.json']
-    return Target(name, action=action, dependencies=dependencies)
+    return Target(name, action=action, dependencies=dependencies,
+                  restat=True)
 
 
 @rule(r'\Abuild/examples/(?P<id>.*).combined.js\Z')
 def examples_star_combined_js(name, match):
     def action(t):
-        t.output('%(JAVA)s', '-jar', PLOVR_JAR, 'build',
-                 'build/examples/%(id)s.json' % match.groupdict())
+        plovr_build(t, 'build/examples/%(id)s.json' % match.groupdict())
         report_sizes(t)
     dependencies = [PLOVR_JAR, SRC, INTERNAL_SRC, SHADER_SRC,
                     'buildcfg/base.json',
                     'examples/%(id)s.js' % match.groupdict(),
                     'build/examples/%(id)s.json' % match.groupdict()]
-    return Target(name, action=action, dependencies=dependencies)
+    # generate every config before the plovr server is started, rather than
+    # restarting it for each new one
+    order_only = EXAMPLES_JSON if variables.PLOVR_WORKER else ()
+    return Target(name, action=action, dependencies=dependencies,
+                  order_only=order_only, remote=['externs'],
+                  resources=PLOVR_RESOURCES)
+
+
+virtual('build-examples-modules', 'build/examples/modules/ol.js')
+
+
+@target('build/examples/modules.json', __file__, 'buildcfg/base.json',
+        EXAMPLES, restat=True)
+def build_examples_modules_json(t):
+    # One plovr config compiling every example as a module that depends on
+    # a shared ol module, so that the library is compiled once and can be
+    # cached by browsers across examples.
+    modules = {
+        'ol': {
+            'inputs': ['../build/src/internal/src/types.js'],
+            'deps': [],
+        },
+    }
+    for example in EXAMPLES:
+        id = os.path.basename(example).replace('.html', '')
+        modules[id] = {
+            'inputs': ['../examples/%s.js' % (id,)],
+            'deps': ['ol'],
+        }
+    content = json.dumps({
+        'id': 'examples-modules',
+        'inherits': '../../buildcfg/base.json',
+        'modules': modules,
+        'module-output-path': '../build/examples/modules/%s.js',
+        'module-production-uri': '%s.js',
+        'externs': EXAMPLES_EXTERNS,
+    })
+    with open(t.name, 'w') as f:
+        f.write(content)
+
+
+@target('build/examples/modules/ol.js', PLOVR_JAR, SRC, INTERNAL_SRC,
+        SHADER_SRC, 'buildcfg/base.json',
+        [path.replace('.html', '.js') for path in EXAMPLES],
+        'build/examples/modules.json', resources=PLOVR_RESOURCES)
+def build_examples_modules_ol_js(t):
+    # plovr writes one file per module, this target is the shared one
+    t.run('%(JAVA)s', '-jar', PLOVR_JAR, 'build',
+          'build/examples/modules.json')
+    report_sizes(t)
 
 
 @target('serve', PLOVR_JAR, INTERNAL_SRC, 'build/test/requireall.js',
@@ -303,11 +426,16 @@ def build_lint_src_timestamp(t):
         path
         for path in ifind('externs', 'build/src/external/externs')
         if path.endswith('.js')]
+    newer = t.newer(t.dependencies)
+    t.metric('gjslint_files', len(newer))
     t.run('%(GJSLINT)s', '--strict', '--limited_doc_files=%s' %
-          (','.join(limited_doc_files),), t.newer(t.dependencies))
+          (','.join(limited_doc_files),), newer)
     t.touch()
 
 
+DOTTED_NAME_RE = re.compile(r'\w+(?:\.\w+)*')
+
+
 def _strip_comments(lines):
     # FIXME this is a horribe hack, we should use a proper JavaScript parser
     # here
@@ -331,62 +459,107 @@ def _strip_comments(lines):
                 yield lineno, line
 
 
+def _match_dotted_names(trie, names):
+    # Like searching for each name in the trie with a \bname\b regular
+    # expression, longest first, but walking each dotted name only once.
+    for name in names:
+        segments = name.split('.')
+        i = 0
+        while i < len(segments):
+            node, match, end = trie, None, i + 1
+            for j in xrange(i, len(segments)):
+                node = node.get(segments[j])
+                if node is None:
+                    break
+                if None in node:
+                    match, end = node[None], j + 1
+            if match is not None:
+                yield match
+            i = end
+
+
+def _scan_requires(filename):
+    """Returns the goog.provides of a file, its goog.requires with their line
+    numbers, the goog.requires found elsewhere in the file, including in
+    comments, and the dotted names in its code."""
+    provides = set()
+    requires = {}
+    names = set()
+    lines = open(filename).readlines()
+    for lineno, line in _strip_comments(lines):
+        m = re.match(r'goog.provide\(\'(.*)\'\);', line)
+        if m:
+            provides.add(m.group(1))
+            continue
+        m = re.match(r'goog.require\(\'(.*)\'\);', line)
+        if m:
+            requires[m.group(1)] = lineno
+            continue
+        names.update(DOTTED_NAME_RE.findall(line))
+    ignore_linenos = set(requires.itervalues())
+    text = ''.join(line for lineno, line in enumerate(lines)
+                   if lineno not in ignore_linenos)
+    used = set(require for require in requires if require in text)
+    return {'provides': sorted(provides), 'requires': requires,
+            'used': sorted(used), 'names': sorted(names)}
+
+
+CHECK_REQUIRES_CACHE = 'build/check-requires-cache.json'
+
+
 @target('build/check-requires-timestamp', SRC, INTERNAL_SRC, EXTERNAL_SRC,
         EXAMPLES_SRC, SHADER_SRC, SPEC)
 def build_check_requires_timestamp(t):
-    unused_count = 0
-    all_provides = set()
-    for filename in sorted(t.dependencies):
+    # Scans are cached by the files' digests, so that after an edit only the
+    # changed files are read again, and discarded when the scanning code
+    # changes.
+    version = '%s %s' % (fingerprint(_scan_requires), DOTTED_NAME_RE.pattern)
+    try:
+        with open(CHECK_REQUIRES_CACHE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    if cache.get('version') != version:
+        cache = {}
+    cache = cache.get('files', {})
+    entries = {}
+    for filename in t.dependencies:
         if filename == 'build/src/internal/src/requireall.js':
             continue
-        require_linenos = {}
-        uses = set()
-        lines = open(filename).readlines()
-        for lineno, line in _strip_comments(lines):
-            m = re.match(r'goog.provide\(\'(.*)\'\);', line)
-            if m:
-                all_provides.add(m.group(1))
-                continue
-            m = re.match(r'goog.require\(\'(.*)\'\);', line)
-            if m:
-                require_linenos[m.group(1)] = lineno
-                continue
-        ignore_linenos = require_linenos.values()
-        for lineno, line in enumerate(lines):
-            if lineno in ignore_linenos:
-                continue
-            for require in require_linenos.iterkeys():
-                if require in line:
-                    uses.add(require)
-        for require in sorted(set(require_linenos.keys()) - uses):
-            t.info('%s:%d: unused goog.require: %r' % (
-                filename, require_linenos[require], require))
+        digest = database.digest(filename)
+        entry = cache.get(filename)
+        if entry is None or entry[0] != digest:
+            entry = [digest, _scan_requires(filename)]
+        entries[filename] = entry
+    t.debug('scanned %d of %d files', sum(
+        1 for filename, entry in entries.iteritems()
+        if cache.get(filename) is not entry), len(entries))
+    with atomic_write(CHECK_REQUIRES_CACHE) as f:
+        json.dump({'version': version, 'files': entries}, f)
+    scans = dict((filename, entry[1])
+                 for filename, entry in entries.iteritems())
+    unused_count = 0
+    all_provides = set()
+    for filename, scan in sorted(scans.iteritems()):
+        all_provides.update(scan['provides'])
+        for require in sorted(set(scan['requires']) - set(scan['used'])):
+            t.info('%s:%d: unused goog.require: \'%s\'' % (
+                filename, scan['requires'][require], require))
             unused_count += 1
     all_provides.discard('ol')
     all_provides.discard('ol.Map')
     all_provides.discard('ol.MapProperty')
-    provide_res = [(provide, re.compile(r'\b%s\b' % (re.escape(
-        provide)),)) for provide in sorted(all_provides, reverse=True)]
+    provide_trie = {}
+    for provide in all_provides:
+        node = provide_trie
+        for segment in provide.split('.'):
+            node = node.setdefault(segment, {})
+        node[None] = provide
     missing_count = 0
-    for filename in sorted(t.dependencies):
+    for filename, scan in sorted(scans.iteritems()):
         if filename in INTERNAL_SRC or filename in EXTERNAL_SRC:
             continue
-        provides = set()
-        requires = set()
-        uses = set()
-        for lineno, line in _strip_comments(open(filename)):
-            m = re.match(r'goog.provide\(\'(.*)\'\);', line)
-            if m:
-                provides.add(m.group(1))
-                continue
-            m = re.match(r'goog.require\(\'(.*)\'\);', line)
-            if m:
-                requires.add(m.group(1))
-                continue
-            for provide, provide_re in provide_res:
-                if provide_re.search(line):
-                    line = line.replace(provide, '')
-                    uses.add(provide)
+        uses = set(_match_dotted_names(provide_trie, scan['names']))
         if filename == 'src/ol/renderer/layerrenderer.js':
             uses.discard('ol.renderer.Map')
         m = re.match(
@@ -394,11 +567,14 @@ def build_check_requires_timestamp(t):
         if m:
             uses.discard('ol.renderer.Map')
             uses.discard('ol.renderer.%s.Map' % (m.group(1),))
-        missing_requires = uses - requires - provides
+        missing_requires = uses - set(scan['requires']) - \
+            set(scan['provides'])
         if missing_requires:
             t.info('%s: missing goog.requires: %s', filename, ', '.join(
                 sorted(missing_requires)))
             missing_count += len(missing_requires)
+    t.metric('unused_requires', unused_count)
+    t.metric('missing_requires', missing_count)
     if unused_count or missing_count:
         t.error('%d unused goog.requires, %d missing goog.requires' %
                 (unused_count, missing_count))
@@ -410,10 +586,8 @@ virtual('plovr', PLOVR_JAR)
 
 @target(PLOVR_JAR, clean=False)
 def plovr_jar(t):
-    t.info('downloading %r', t.name)
     t.download('https://plovr.googlecode.com/files/' +
                os.path.basename(PLOVR_JAR), md5=PLOVR_JAR_MD5)
-    t.info('downloaded %r', t.name)
 
 
 @target('gh-pages', 'host-examples', 'doc', phony=True)
@@ -430,12 +604,12 @@ def gh_pages(t):
             t.run('%(GIT)s', 'push', 'origin', 'gh-pages')
 
 
-virtual('doc', 'build/jsdoc-%(BRANCH)s-timestamp' % vars(variables))
+virtual('doc', 'build/jsdoc-timestamp')
 
 
-@target('build/jsdoc-%(BRANCH)s-timestamp' % vars(variables), SRC, SHADER_SRC,
-        ifind('doc/template'))
-def jsdoc_BRANCH_timestamp(t):
+# the branch is part of the command line, so switching branches rebuilds
+@target('build/jsdoc-timestamp', SRC, SHADER_SRC, ifind('doc/template'))
+def jsdoc_timestamp(t):
     t.run('%(JSDOC)s', '-t', 'doc/template', '-r',
           'src', '-d', 'build/gh-pages/%(BRANCH)s/apidoc')
     t.touch()
@@ -483,7 +657,7 @@ def host_examples(t):
     t.makedirs(build_dir)
     t.cp(EXAMPLES, 'examples/examples.css', examples_dir)
     for example in [path.replace('.html', '.js') for path in EXAMPLES]:
-        split_example_file(example, examples_dir % vars(variables))
+        split_example_file(example, examples_dir % variables)
     t.cp_r('examples/data', examples_dir + '/data')
     t.cp_r('examples/bootstrap', examples_dir + '/bootstrap')
     t.cp_r('examples/font-awesome', examples_dir + '/font-awesome')
@@ -509,16 +683,31 @@ def host_examples(t):
           '--output_file', 'build/gh-pages/%(BRANCH)s/build/ol-deps.js')
 
 
-@target('check-examples', 'host-examples', phony=True)
-def check_examples(t):
-    examples = ['build/gh-pages/%(BRANCH)s/' + e for e in EXAMPLES]
-    all_examples = \
-        [e + '?mode=raw' for e in examples] + \
-        [e + '?mode=whitespace' for e in examples] + \
-        [e + '?mode=simple' for e in examples] + \
-        examples
-    for example in all_examples:
-        t.run('%(PHANTOMJS)s', 'bin/check-example.js', example)
+# the modules for mode=modules take a compile of every example, so they are
+# only hosted on request
+@target('host-examples-modules', 'host-examples',
+        'build/examples/modules/ol.js', phony=True)
+def host_examples_modules(t):
+    build_dir = 'build/gh-pages/%(BRANCH)s/build'
+    t.rm_rf(build_dir + '/modules')
+    t.cp_r('build/examples/modules', build_dir + '/modules')
+
+
+# one target per example, so that -k reports every broken example
+virtual('check-examples', ['check-examples/' + os.path.basename(example)
+                           for example in EXAMPLES])
+
+
+@rule(r'\Acheck-examples/(?P<name>.*)\Z')
+def check_examples_star(name, match):
+    def action(t):
+        hosted = 'build/gh-pages/%(BRANCH)s/examples/' + match.group('name')
+        for mode in ('?mode=raw', '?mode=whitespace', '?mode=simple', ''):
+            t.run('%(PHANTOMJS)s', 'bin/check-example.js', hosted + mode)
+    return Target(name, action=action, dependencies=['host-examples'],
+                  makedirs=False, phony=True,
+                  remote=['build/gh-pages/%(BRANCH)s'],
+                  resources=PHANTOMJS_RESOURCES)
 
 
 @target(PROJ4JS, PROJ4JS_ZIP)
@@ -532,13 +721,12 @@ def proj4js(t):
 
 @target(PROJ4JS_ZIP, clean=False)
 def proj4js_zip(t):
-    t.info('downloading %r', t.name)
     t.download('http://download.osgeo.org/proj4js/' +
                os.path.basename(t.name), md5=PROJ4JS_ZIP_MD5)
-    t.info('downloaded %r', t.name)
 
 
-@target('test', INTERNAL_SRC, PROJ4JS, 'build/test/requireall.js', phony=True)
+@target('test', INTERNAL_SRC, PROJ4JS, 'build/test/requireall.js', phony=True,
+        resources=PHANTOMJS_RESOURCES)
 def test(t):
     t.run('%(PHANTOMJS)s', 'test/mocha-phantomjs.coffee', 'test/ol.html')
 
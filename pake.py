@@ -2,17 +2,27 @@
 
 import collections
 import contextlib
+import errno
 import hashlib
+import heapq
+import json
 import logging
 import optparse
 import os
+import Queue
 import re
+import select
 import shutil
+import socket
+import sre_constants
+import sre_parse
 import subprocess
 import tempfile
+import struct
 import sys
+import threading
 import time
-import urllib2
+import types
 
 
 logger = logging.getLogger(__name__)
@@ -38,6 +48,16 @@ else:
             raise subprocess.CalledProcessError(retcode, cmd, output=output)
         return output
 
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# the mode of newly created files is masked by the umask, which can only be
+# read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
 
 class PakeError(RuntimeError):
     pass
@@ -62,6 +82,29 @@ class BuildError(PakeError):
         return '%s: %s' % (self.target.name, self.message)
 
 
+class BuildErrors(PakeError):
+    """The errors of all the targets that failed in keep going mode."""
+
+    def __init__(self, errors, blocked):
+        self.errors = errors
+        self.blocked = blocked
+
+    def __str__(self):
+        lines = ['%d target(s) failed, %d target(s) not built because of them'
+                 % (len(self.errors), self.blocked)]
+        lines.extend('  %s' % (error,) for error in self.errors)
+        return '\n'.join(lines)
+
+
+class DependencyCycleError(PakeError):
+
+    def __init__(self, target):
+        self.target = target
+
+    def __str__(self):
+        return 'dependency cycle through %r' % (self.target.name,)
+
+
 class DuplicateTargetError(PakeError):
 
     def __init__(self, target):
@@ -71,144 +114,1157 @@ class DuplicateTargetError(PakeError):
         return 'duplicate target %r' % (self.target.name,)
 
 
+class Cache(object):
+    """A content-addressed store of action outputs, evicted least recently
+    used first."""
+
+    def __init__(self, path=os.path.join('~', '.cache', 'pake'),
+                 size=1024 * 1024 * 1024):
+        self.enabled = False
+        self.path = path
+        self.size = size
+
+    def entry(self, key):
+        return os.path.join(os.path.expanduser(self.path), key[:2], key[2:])
+
+    def evict(self):
+        entries = []
+        for dirpath, dirnames, names in os.walk(os.path.expanduser(self.path)):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.size:
+                break
+            logger.debug('evicting %s from cache', path)
+            os.remove(path)
+            size -= entry_size
+
+    def key(self, target, args):
+        """Returns the key of an action from the contents of the target's
+        dependencies, its command line and the variables it uses."""
+        sha1 = hashlib.sha1()
+        for arg in flatten(args):
+            for name in re.findall(r'%\((\w+)\)', arg):
+                sha1.update('%s=%s\0' % (name, getattr(variables, name)))
+        for arg in flatten_expand_list(args):
+            sha1.update(arg + '\0')
+        sha1.update('%s\0' % (target._cwd,))
+        for dependency in sorted(set(target.dependencies)):
+            sha1.update('%s\0%s\0' % (dependency,
+                                        database.digest(dependency)))
+        return sha1.hexdigest()
+
+    @staticmethod
+    def output_key(key, output):
+        """Returns the key of a side output of the action with key."""
+        return hashlib.sha1('%s\0%s' % (key, output)).hexdigest()
+
+    def restore(self, key, path, outputs=()):
+        """Copies the entry of key to path and the entries of the action's
+        side outputs over them, only if all of them are in the cache."""
+        entries = [self.entry(self.output_key(key, output))
+                   for output in outputs]
+        try:
+            # the mtime of an entry is its last use
+            for entry in entries + [self.entry(key)]:
+                os.utime(entry, None)
+            for entry, output in zip(entries, outputs):
+                with atomic_write(output) as f:
+                    with open(entry, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+            shutil.copyfile(self.entry(key), path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def store(self, key, path, outputs=()):
+        """Stores path under key, and the action's side outputs with it."""
+        for output in outputs:
+            if not os.path.isfile(output):
+                return
+        for output in outputs:
+            self.store_file(self.output_key(key, output), output)
+        self.store_file(key, path)
+
+    def store_file(self, key, path):
+        with atomic_write(self.entry(key)) as f:
+            with open(path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+
+class Database(object):
+
+    def __init__(self, path='build/.pakedb'):
+        self.path = path
+        self.signatures = False
+        self.directories = {}
+        self.files = {}
+        self.targets = {}
+        self._dirty = False
+        self._loaded = False
+
+    def digest(self, path):
+        stat = snapshot.stat(path)
+        if stat is None:
+            return None
+        entry = self.files.get(path)
+        if entry and entry[0] == stat[0] and entry[1] == stat[1]:
+            return entry[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        # a file modified within the mtime resolution might change again
+        # without its mtime or size changing
+        if time.time() - stat[0] > 1:
+            self.files[path] = [stat[0], stat[1], digest]
+            self._dirty = True
+        elif self.files.pop(path, None):
+            self._dirty = True
+        return digest
+
+    def listdir(self, path):
+        """Returns the subdirectories and the files in path, reusing the
+        listing from a previous run while the mtime of path is unchanged.
+        Like os.walk, links to directories are not listed as either."""
+        self.load()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            if self.directories.pop(path, None):
+                self._dirty = True
+            raise
+        entry = self.directories.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1], entry[2]
+        dirnames, filenames = [], []
+        if scandir:
+            for entry in scandir(path):
+                if not entry.is_dir():
+                    filenames.append(entry.name)
+                elif not entry.is_symlink():
+                    dirnames.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                dirpath = os.path.join(path, name)
+                if not os.path.isdir(dirpath):
+                    filenames.append(name)
+                elif not os.path.islink(dirpath):
+                    dirnames.append(name)
+        # a directory modified within the mtime resolution might change again
+        # without its mtime changing
+        if time.time() - mtime > 1:
+            self.directories[path] = [mtime, dirnames, filenames]
+            self._dirty = True
+        return dirnames, filenames
+
+    def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+        except (IOError, ValueError):
+            return
+        if content.get('version') == 1:
+            # json loads names as unicode, but os.listdir returns them as str
+            self.directories = dict(
+                (path, [mtime, [name.encode('utf-8') for name in dirnames],
+                        [name.encode('utf-8') for name in filenames]])
+                for path, (mtime, dirnames, filenames)
+                in content.get('directories', {}).iteritems())
+            self.files = content['files']
+            self.targets = content['targets']
+
+    def record(self, name, **kwargs):
+        self.targets.setdefault(name, {}).update(kwargs)
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        content = {'version': 1, 'directories': self.directories,
+                   'files': self.files, 'targets': self.targets}
+        with atomic_write(self.path) as f:
+            json.dump(content, f)
+        self._dirty = False
+
+
+class Dependencies(object):
+    """An immutable sequence of dependency names.  Names given as a list, such
+    as a list of source files, are kept as a group that is interned so that
+    all the targets depending on the same files share one copy."""
+
+    __slots__ = ('_groups',)
+
+    groups = {}
+
+    def __init__(self, dependencies):
+        groups = []
+        names = []
+        for dependency in dependencies:
+            if isinstance(dependency, basestring):
+                names.append(dependency)
+                continue
+            if names:
+                groups.append(self.intern(names))
+                names = []
+            groups.append(self.intern(flatten(dependency)))
+        if names:
+            groups.append(self.intern(names))
+        self._groups = tuple(groups)
+
+    def __contains__(self, name):
+        return any(name in group for group in self._groups)
+
+    def __iter__(self):
+        for group in self._groups:
+            for name in group:
+                yield name
+
+    def __len__(self):
+        return sum(len(group) for group in self._groups)
+
+    def __repr__(self):
+        return 'Dependencies(%r)' % (list(self),)
+
+    @classmethod
+    def intern(cls, names):
+        group = tuple(names)
+        return cls.groups.setdefault(group, group)
+
+
+class DownloadCache(object):
+    """A store of verified downloads, keyed by their md5 or sha1, shared by
+    all projects of the user.  Downloads are first looked for in mirrors,
+    directories or base URLs holding files under the same names."""
+
+    def __init__(self, path=os.path.join('~', '.cache', 'pake-downloads')):
+        self.mirrors = []
+        self.path = path
+
+    def entry(self, algorithm, digest):
+        return os.path.join(os.path.expanduser(self.path), algorithm, digest)
+
+    def restore(self, digests, path):
+        for algorithm, digest in sorted(digests.iteritems()):
+            try:
+                shutil.copyfile(self.entry(algorithm, digest), path)
+            except (IOError, OSError):
+                continue
+            return True
+        return False
+
+    def store(self, digests, path):
+        for algorithm, digest in digests.iteritems():
+            with atomic_write(self.entry(algorithm, digest)) as f:
+                with open(path, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+
+    def urls(self, url):
+        """Returns the URLs to download url from, the mirrors' first."""
+        import urllib
+        import urlparse
+        basename = urlparse.urlsplit(url).path.rpartition('/')[2]
+        urls = []
+        for mirror in self.mirrors:
+            if '://' in mirror:
+                urls.append(mirror.rstrip('/') + '/' + basename)
+            else:
+                path = os.path.join(os.path.expanduser(mirror), basename)
+                urls.append('file:' + urllib.pathname2url(
+                    os.path.abspath(path)))
+        urls.append(url)
+        return urls
+
+
+class Jobserver(object):
+    """A GNU make jobserver, a pipe holding a token for every job that may run
+    in addition to the first one.  The jobserver is shared with make and
+    with the other tools started by the build."""
+
+    def __init__(self, read, write, jobs=None):
+        self.read = read
+        self.write = write
+        self.jobs = jobs
+        self.tokens = []
+
+    def acquire(self):
+        """Takes a token if one is available, without blocking."""
+        if not select.select([self.read], [], [], 0)[0]:
+            return False
+        try:
+            token = os.read(self.read, 1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+        if not token:
+            return False
+        self.tokens.append(token)
+        return True
+
+    @classmethod
+    def create(cls, jobs):
+        """Creates a jobserver for jobs and advertises it to child processes
+        in MAKEFLAGS."""
+        read, write = os.pipe()
+        os.write(write, '+' * (jobs - 1))
+        flags = re.sub(r'(?:\A|\s)(?:-j\d*|--jobserver-\S+)', '',
+                       os.environ.get('MAKEFLAGS', ''))
+        os.environ['MAKEFLAGS'] = '%s -j%d --jobserver-fds=%d,%d ' \
+            '--jobserver-auth=%d,%d' % (flags, jobs, read, write, read, write)
+        return cls(cls.nonblocking(read), write, jobs)
+
+    @classmethod
+    def from_environ(cls):
+        """Returns the jobserver advertised in MAKEFLAGS by a parent make, or
+        None."""
+        flags = os.environ.get('MAKEFLAGS', '')
+        match = re.search(r'--jobserver-(?:auth|fds)=(?:fifo:(?P<fifo>\S+)|'
+                          r'(?P<read>\d+),(?P<write>\d+))', flags)
+        if not match:
+            return None
+        jobs = re.search(r'(?:\A|\s)-j(\d+)', flags)
+        jobs = int(jobs.group(1)) if jobs else None
+        try:
+            if match.group('fifo'):
+                read = os.open(match.group('fifo'),
+                               os.O_RDONLY | os.O_NONBLOCK)
+                write = os.open(match.group('fifo'), os.O_WRONLY)
+            else:
+                read, write = map(int, match.group('read', 'write'))
+                os.fstat(read)
+                os.fstat(write)
+                read = cls.nonblocking(read)
+        except OSError:
+            logger.warning('jobserver unavailable, is the make rule marked '
+                           'with +?')
+            return None
+        return cls(read, write, jobs)
+
+    @staticmethod
+    def nonblocking(fd):
+        """Returns a non-blocking descriptor reading from the pipe fd, without
+        changing the mode of fd, which is shared with other processes."""
+        try:
+            return os.open('/proc/self/fd/%d' % (fd,),
+                           os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            # another process may take the token between select and read,
+            # in which case the read blocks until a token is returned
+            return fd
+
+    def release(self, keep):
+        """Returns tokens to the jobserver until keep tokens are held."""
+        while len(self.tokens) > keep:
+            os.write(self.write, self.tokens.pop())
+
+
+class Lazy(object):
+    """A variable value computed by calling function on first use."""
+
+    def __init__(self, function):
+        self.function = function
+
+
+class MetricsExporter(object):
+    """Writes the durations, statuses and metrics of the actions and of the
+    build to path, as a Prometheus textfile if path ends with .prom and as
+    JSON lines appended to path otherwise."""
+
+    def __init__(self, path):
+        self.path = path
+        self.actions = []
+        self._lock = threading.Lock()
+        hook('post-action')(self.action)
+        hook('build-finished')(self.finish)
+
+    def action(self, data):
+        with self._lock:
+            self.actions.append(data)
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+    def finish(self, data):
+        if self.path.endswith('.prom'):
+            content = self.prometheus(data)
+            # the textfile collector may read the file at any time
+            with atomic_write(self.path, 0644) as f:
+                f.write(content)
+        else:
+            with open(self.path, 'a') as f:
+                for action in self.actions:
+                    f.write(json.dumps(dict(action, event='action')) + '\n')
+                f.write(json.dumps(dict(data, event='build')) + '\n')
+
+    def prometheus(self, data):
+        # a target rebuilt several times, as in watch mode, keeps its latest
+        # samples
+        samples = collections.defaultdict(dict)
+        for action in self.actions:
+            target = (('target', action['target']),)
+            samples['pake_action_duration_seconds'][target] = \
+                action['duration']
+            samples['pake_action_success'][target] = \
+                int(action['status'] == 'ok')
+            for metric in action['metrics']:
+                name = 'pake_' + re.sub(r'\W', '_', metric['name'])
+                labels = tuple(sorted(metric['labels'].items())) + target
+                samples[name][labels] = metric['value']
+        samples['pake_build_actions'][()] = len(self.actions)
+        samples['pake_build_duration_seconds'][()] = data['duration']
+        samples['pake_build_failed_actions'][()] = sum(
+            1 for action in self.actions if action['status'] != 'ok')
+        samples['pake_build_success'][()] = int(data['status'] == 'ok')
+        lines = []
+        for name in sorted(samples):
+            lines.append('# TYPE %s gauge' % (name,))
+            for labels, value in sorted(samples[name].iteritems()):
+                if labels:
+                    name_labels = '%s{%s}' % (name, ','.join(
+                        '%s="%s"' % (key, self.escape(label))
+                        for key, label in labels))
+                else:
+                    name_labels = name
+                lines.append('%s %s' % (name_labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class RuleCollection(object):
+    """Indexes rules by the literal prefix of their pattern, so that only the
+    rules that can possibly match a name are tried."""
+
+    def __init__(self):
+        self.index = {}
+        self.lengths = []
+
+    def add(self, pattern, targetmaker):
+        regexp = re.compile(pattern)
+        prefix = literal_prefix(regexp)
+        if prefix not in self.index:
+            self.index[prefix] = []
+            self.lengths = sorted(set(self.lengths + [len(prefix)]))
+        self.index[prefix].append((regexp, targetmaker))
+
+    def candidates(self, name):
+        for length in self.lengths:
+            if length > len(name):
+                break
+            for candidate in self.index.get(name[:length], ()):
+                yield candidate
+
+
+class Scheduler(object):
+
+    def __init__(self, jobs=1, dry_run=False, explain=False, jobserver=None,
+                 keep_going=False, load=None, pools=None, workers=()):
+        self.jobs = jobs
+        self.dry_run = dry_run
+        self.explain = explain
+        self.jobserver = jobserver
+        self.keep_going = keep_going
+        self.load = load
+        self.pools = pools or {}
+        self.priorities = {}
+        self.used = collections.defaultdict(int)
+        self.workers = workers
+
+    def admit(self, ready, local):
+        """Removes and returns the ready target with the highest priority that
+        can start now, or None.  A remote target goes to the least busy
+        worker with spare capacity.  Otherwise, the target runs locally if
+        fewer than jobs local actions are running and its resources fit in
+        their pools, unless no running action holds any of them.  No local
+        action starts while the load average is over the limit unless none
+        is running."""
+        overloaded = (local and self.load is not None and
+                      os.getloadavg()[0] >= self.load)
+        skipped = []
+        target = None
+        while ready:
+            item = heapq.heappop(ready)
+            candidate = item[-1]
+            if candidate.action is None:
+                target = candidate
+                break
+            if candidate.remote:
+                workers = [worker for worker in self.workers
+                           if worker.running < worker.capacity]
+                if workers:
+                    candidate._worker = min(
+                        workers, key=lambda worker:
+                        float(worker.running) / worker.capacity)
+                    candidate._worker.running += 1
+                    target = candidate
+                    break
+            if local < self.jobs and not overloaded and all(
+                    pool not in self.pools or not self.used[pool] or
+                    self.used[pool] + amount <= self.pools[pool]
+                    for pool, amount in candidate.resources):
+                target = candidate
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(ready, item)
+        return target
+
+    def build(self, order):
+        """Brings the targets in order, which lists dependencies before their
+        dependents, up to date.  In keep going mode, a target that fails
+        only stops its dependents, and the errors are raised together at
+        the end."""
+        errors = []
+        if self.jobs == 1 and not self.workers:
+            failed = set()
+            for target in order:
+                if any(targets.get(dependency) in failed
+                       for dependency in target.prerequisites()):
+                    failed.add(target)
+                    continue
+                try:
+                    self.update(target)
+                except BuildError as e:
+                    if not self.keep_going:
+                        raise
+                    errors.append(e)
+                    failed.add(target)
+            if errors:
+                raise BuildErrors(errors, len(failed) - len(errors))
+            return
+        pending = {}
+        dependents = collections.defaultdict(list)
+        for target in order:
+            dependencies = set(map(targets.get, target.prerequisites()))
+            pending[target] = len(dependencies)
+            for dependency in dependencies:
+                dependents[dependency].append(target)
+        # start the targets with the longest chain of actions after them
+        # first, estimated from the durations recorded by previous runs
+        remaining = {}
+        for position in xrange(len(order) - 1, -1, -1):
+            target = order[position]
+            remaining[target] = max(
+                [remaining[dependent] for dependent in dependents[target]] or
+                [0])
+            if target.action is not None:
+                remaining[target] += database.targets.get(
+                    target.name, {}).get('duration', 0)
+            self.priorities[target] = (-remaining[target], position)
+        ready = []
+        for target in order:
+            if not pending[target]:
+                heapq.heappush(ready, self.priorities[target] + (target,))
+        queue, results = Queue.Queue(), Queue.Queue()
+        threads = []
+        for i in xrange(self.jobs +
+                        sum(worker.capacity for worker in self.workers)):
+            thread = threading.Thread(target=self.work, args=(queue, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        local = running = 0
+        error = None
+        while True:
+            waiting = False
+            while ready and error is None:
+                target = self.admit(ready, local)
+                if target is None:
+                    break
+                if target.action is None:
+                    self.update(target)
+                    self.finish(target, pending, dependents, ready)
+                    continue
+                if target._worker is None:
+                    if (local and self.jobserver is not None and
+                            not self.jobserver.acquire()):
+                        # every local action but the first needs a jobserver
+                        # token
+                        heapq.heappush(ready,
+                                       self.priorities[target] + (target,))
+                        waiting = True
+                        break
+                    for pool, amount in target.resources:
+                        self.used[pool] += amount
+                    local += 1
+                target._buffer = []
+                queue.put(target)
+                running += 1
+            if not running:
+                break
+            # Queue.get is only interruptible with a timeout in Python 2, and
+            # a high load average and jobserver tokens are polled
+            if waiting:
+                timeout = 0.05
+            elif self.load is not None:
+                timeout = 1
+            else:
+                timeout = 86400
+            try:
+                target, exc_info = results.get(True, timeout)
+            except Queue.Empty:
+                continue
+            running -= 1
+            if target._worker is not None:
+                target._worker.running -= 1
+                target._worker = None
+            else:
+                local -= 1
+                if self.jobserver is not None:
+                    self.jobserver.release(max(local - 1, 0))
+                for pool, amount in target.resources:
+                    self.used[pool] -= amount
+            target.flush()
+            if exc_info is None:
+                self.finish(target, pending, dependents, ready)
+            elif self.keep_going and issubclass(exc_info[0], BuildError):
+                errors.append(exc_info[1])
+            elif error is None:
+                error = exc_info
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if self.jobserver is not None:
+            self.jobserver.release(0)
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if errors:
+            raise BuildErrors(errors, sum(1 for target in order
+                                          if pending[target]))
+
+    def finish(self, target, pending, dependents, ready):
+        for dependent in dependents[target]:
+            pending[dependent] -= 1
+            if not pending[dependent]:
+                heapq.heappush(ready,
+                               self.priorities[dependent] + (dependent,))
+
+    def update(self, target):
+        timestamp = 0
+        for dependency in target.dependencies:
+            timestamp = max(timestamp, targets.get(dependency).timestamp)
+        target.update(timestamp, dry_run=self.dry_run, explain=self.explain)
+
+    def work(self, queue, results):
+        while True:
+            target = queue.get()
+            if target is None:
+                break
+            try:
+                self.update(target)
+                results.put((target, None))
+            except:
+                results.put((target, sys.exc_info()))
+
+
+class Service(object):
+    """A long-lived process, such as a compile server, shared by actions."""
+
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.args = None
+        self.process = None
+        self._condition = threading.Condition()
+        self._users = 0
+        services.append(self)
+
+    def connect(self, timeout=1):
+        return socket.create_connection(('localhost', self.port), timeout)
+
+    def request(self, path):
+        import urllib2
+        return urllib2.urlopen(
+            'http://localhost:%d%s' % (self.port, path)).read()
+
+    def start(self, target, args, log=None):
+        self.stop()
+        self.port = int(str(self.port) % variables)
+        try:
+            self.connect().close()
+        except socket.error:
+            pass
+        else:
+            target.error('port %d of service %s is in use' %
+                         (self.port, self.name))
+        target.info('%s &', ' '.join(args))
+        with open(log or os.devnull, 'a') as f:
+            self.process = subprocess.Popen(args, stdout=f,
+                                            stderr=subprocess.STDOUT)
+        self.args = args
+        while True:
+            try:
+                self.connect().close()
+                break
+            except socket.error:
+                if self.process.poll() is not None:
+                    self.process = self.args = None
+                    target.error('service %s exited' % (self.name,))
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            logger.debug('stopping service %s', self.name)
+            self.process.terminate()
+            self.process.wait()
+        self.process = self.args = None
+
+    @contextlib.contextmanager
+    def use(self, target, *args, **kwargs):
+        """Yields the service running args, starting it if needed.  A service
+        running different arguments is restarted once no action uses it."""
+        args = flatten_expand_list(args)
+        with self._condition:
+            while self._users and self.args != args:
+                self._condition.wait()
+            if self.args != args or self.process.poll() is not None:
+                self.start(target, args, **kwargs)
+            self._users += 1
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._users -= 1
+                self._condition.notify_all()
+
+
+class Snapshot(object):
+    """The directory listings and the file stats read during a build, so that
+    each is read at most once until it is invalidated."""
+
+    def __init__(self):
+        self.directories = {}
+        self.stats = {}
+
+    def clear(self):
+        self.directories.clear()
+        self.stats.clear()
+
+    def invalidate(self, path):
+        """Forgets path and the listing of the directory containing it."""
+        self.directories.pop(os.path.dirname(path), None)
+        self.stats.pop(path, None)
+
+    def listdir(self, path):
+        # worker threads clear the snapshot concurrently, so only what was
+        # read or computed here is returned
+        listing = self.directories.get(path)
+        if listing is None:
+            listing = self.directories[path] = database.listdir(path)
+        return listing
+
+    def stat(self, path):
+        """Returns the mtime and the size of path, or None if it does not
+        exist."""
+        try:
+            return self.stats[path]
+        except KeyError:
+            pass
+        try:
+            stat = os.stat(path)
+            result = (stat.st_mtime, stat.st_size)
+        except OSError:
+            result = None
+        self.stats[path] = result
+        return result
+
+
 class Target(object):
 
+    __slots__ = ('name', 'action', '_clean', 'dependencies', '_makedirs',
+                 'order_only', 'outputs', 'phony', 'precious', 'remote',
+                 'resources', 'restat', 'signature', '_stale', 'timestamp',
+                 '_buffer', '_cwd', '_recording', '_worker')
+
     def __init__(self, name, action=None, clean=True, dependencies=(),
-                 makedirs=True, phony=False, precious=False):
+                 makedirs=True, order_only=(), outputs=(), phony=False,
+                 precious=False, remote=False, resources=None,
+                 restat=False):
         self.name = name
         self.action = action
         self._clean = clean
-        self.dependencies = list(flatten(dependencies))
+        self.dependencies = Dependencies(dependencies)
         self._makedirs = makedirs
+        # targets brought up to date first, whose changes do not make this
+        # one stale
+        self.order_only = Dependencies(order_only)
+        # other files written by the action, cached and cleaned with the
+        # target
+        self.outputs = tuple(outputs)
         self.phony = phony
         self.precious = precious
-        self.logger = logging.getLogger(self.name)
+        # True, or a list of the files and directories to send in addition
+        # to the dependencies, if the action's commands can run on a worker
+        self.remote = remote
+        # the amounts of each pool, such as jvm or mem, held by the action
+        self.resources = tuple(sorted(
+            (pool, quantity(amount))
+            for pool, amount in (resources or {}).iteritems()))
+        self.restat = restat
+        self.signature = None
+        self._stale = None
         self.timestamp = None
+        self._buffer = None
+        self._cwd = None
+        self._recording = None
+        self._worker = None
 
     def build(self, dry_run=False):
-        timestamp = 0
-        for dependency in self.dependencies:
-            target = targets.get(dependency)
-            timestamp = max(timestamp, target.build(dry_run=dry_run))
-        self.debug('build')
-        if self.timestamp is None:
-            if not self.phony and os.path.exists(self.name):
-                self.timestamp = os.stat(self.name).st_mtime
-            else:
-                self.timestamp = -1
-        if self.timestamp < timestamp:
-            self.debug('action')
-            if self._makedirs and not dry_run:
-                self.makedirs(os.path.dirname(self.name))
-            if self.action:
-                if self.action.__doc__:
-                    self.info(self.action.__doc__)
-                if not dry_run:
-                    self.action(self)
-            self.timestamp = timestamp or time.time()
+        Scheduler(dry_run=dry_run).build(toposort([self]))
         return self.timestamp
 
+    def call(self, args, capture=False, stdout=None, **kwargs):
+        if trace.enabled:
+            with trace.subprocess(self, args):
+                return self._call(args, capture=capture, stdout=stdout,
+                                  **kwargs)
+        return self._call(args, capture=capture, stdout=stdout, **kwargs)
+
+    def _call(self, args, capture=False, stdout=None, **kwargs):
+        # Captured output is returned, or streamed to stdout if it is given
+        # so that large outputs are never held in memory.
+        kwargs.setdefault('cwd', self._cwd)
+        if self._worker is not None:
+            return self._worker.call(self, args, capture=capture,
+                                     stdout=stdout, **kwargs)
+        if self._buffer is None and (not capture or stdout is not None):
+            subprocess.check_call(args, stdout=stdout, **kwargs)
+            return None
+        if self._buffer is None:
+            return check_output(args, **kwargs)
+        # Buffered targets collect the child's output so that it is written
+        # in one piece with the target's log messages once it has finished.
+        process = subprocess.Popen(
+            args, stdout=stdout or subprocess.PIPE,
+            stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+            **kwargs)
+        output, errors = process.communicate()
+        self._buffer.append(errors if capture else output)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        return output
+
     @contextlib.contextmanager
     def chdir(self, dir):
-        cwd = os.getcwd()
-        dir = dir % vars(variables)
+        # The working directory is tracked per target rather than changed
+        # with os.chdir, which would affect actions running concurrently.
+        cwd = self._cwd
+        dir = dir % variables
         self.info('cd %s', dir)
-        os.chdir(dir)
+        self._cwd = self.path(dir)
         try:
             yield dir
         finally:
-            self.info('cd %s', cwd)
-            os.chdir(cwd)
+            self.info('cd %s', cwd or os.getcwd())
+            self._cwd = cwd
 
     def cp(self, *args):
         args = flatten_expand_list(args)
         dest = args.pop()
         for arg in args:
             self.info('cp %s %s', arg, dest)
-            shutil.copy(arg, dest)
+            shutil.copy(self.path(arg), self.path(dest))
 
     def cp_r(self, *args):
         args = flatten_expand_list(args)
         dest = args.pop()
         for arg in args:
             self.info('cp -r %s %s', arg, dest)
-            shutil.copytree(arg, dest)
+            shutil.copytree(self.path(arg), self.path(dest))
+
+    def command(self, names):
+        """Returns a digest of the action's code and of the values of the
+        variables named by names."""
+        sha1 = hashlib.sha1(fingerprint(self.action))
+        for name in sorted(names):
+            sha1.update('\0%s=%s' % (name, getattr(variables, name, None)))
+        return sha1.hexdigest()
 
     def clean(self, really=False, recurse=True):
-        if (self._clean or really) and not self.precious:
-            self.info('clean')
-            try:
-                os.remove(self.name)
-            except OSError:
-                pass
         if recurse:
-            for dependency in self.dependencies:
-                targets.get(dependency).clean(really=really, recurse=recurse)
+            for target in toposort([self]):
+                target.clean(really=really, recurse=False)
+        elif (self._clean or really) and not self.precious:
+            self.info('clean')
+            for path in (self.name,) + self.outputs:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
     def debug(self, *args, **kwargs):
-        self.logger.debug(*args, **kwargs)
+        self.log(logging.DEBUG, *args, **kwargs)
 
     def download(self, url, md5=None, sha1=None):
-        content = urllib2.urlopen(url).read()
-        if md5 and hashlib.md5(content).hexdigest() != md5:
-            raise BuildError(self, 'corrupt download')
-        if sha1 and hashlib.sha1(content).hexdigest() != sha1:
-            raise BuildError(self, 'corrupt download')
-        with open(self.name, 'wb') as f:
-            f.write(content)
+        """Downloads url to the target, checking its md5 or sha1 as it is
+        streamed to disk.  Checked downloads are kept in the download
+        cache."""
+        import urllib2
+        digests = dict((algorithm, digest)
+                       for algorithm, digest in (('md5', md5), ('sha1', sha1))
+                       if digest)
+        with atomic_write(self.name) as f:
+            if digests and downloads.restore(digests, f.name):
+                self.info('restored %s from download cache', self.name)
+                return
+            for candidate in downloads.urls(url):
+                self.info('downloading %s', candidate)
+                f.seek(0)
+                f.truncate()
+                hashes = dict((algorithm, hashlib.new(algorithm))
+                              for algorithm in digests)
+                try:
+                    response = urllib2.urlopen(candidate)
+                    for chunk in iter(lambda: response.read(65536), ''):
+                        f.write(chunk)
+                        for h in hashes.itervalues():
+                            h.update(chunk)
+                except (IOError, ValueError) as e:
+                    error = 'download failed: %s' % (e,)
+                    self.info('%s', error)
+                    continue
+                if all(hashes[algorithm].hexdigest() == digest
+                       for algorithm, digest in digests.iteritems()):
+                    break
+                error = 'corrupt download'
+                self.info('%s from %s', error, candidate)
+            else:
+                self.error(error)
+            f.close()
+            if digests:
+                downloads.store(digests, f.name)
 
     def error(self, message):
         raise BuildError(self, message)
 
-    def graph(self, f, visited):
-        if self in visited:
-            return
-        visited.add(self)
-        for dependency in self.dependencies:
-            target = targets.get(dependency)
-            f.write('\t"%s" -> "%s";\n' % (self.name, target.name))
-            target.graph(f, visited)
+    def flush(self):
+        buffer, self._buffer = self._buffer, None
+        for item in buffer or ():
+            if isinstance(item, logging.LogRecord):
+                logger.handle(item)
+            else:
+                sys.stdout.write(item)
+        sys.stdout.flush()
+
+    def graph(self, f):
+        for dependency in unique(self.dependencies):
+            f.write('\t"%s" -> "%s";\n' % (self.name, dependency))
+
+    def inputs(self):
+        return dict((dependency, targets.get(dependency).signature)
+                    for dependency in self.dependencies)
 
     def info(self, *args, **kwargs):
-        self.logger.info(*args, **kwargs)
+        self.log(logging.INFO, *args, **kwargs)
+
+    def log(self, level, msg, *args, **kwargs):
+        # Messages go through the pake logger under the target's name, which
+        # avoids creating a logger, cached forever, for every target.
+        if not logger.isEnabledFor(level):
+            return
+        exc_info = kwargs.get('exc_info')
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        record = logger.makeRecord(self.name, level, '(unknown file)', 0, msg,
+                                   args, exc_info)
+        if self._buffer is None:
+            logger.handle(record)
+        else:
+            self._buffer.append(record)
 
     def makedirs(self, path):
-        path = path % vars(variables)
-        if path and not os.path.exists(path):
+        path = path % variables
+        if path and not os.path.exists(self.path(path)):
             self.info('mkdir -p %s', path)
-            os.makedirs(path)
+            try:
+                os.makedirs(self.path(path))
+            except OSError as e:
+                # another target may have created it concurrently
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def metric(self, name, value, **labels):
+        """Reports a measurement made by the action, such as the size of an
+        output, to the post-action hooks."""
+        if self._recording is not None:
+            self._recording['metrics'].append(
+                {'name': name, 'value': value, 'labels': labels})
 
     def newer(self, *args):
         args = flatten_expand_list(args)
+        if database.signatures:
+            inputs = database.targets.get(self.name, {}).get('inputs', {})
+            return [arg for arg in args
+                    if targets.get(arg).signature != inputs.get(arg)]
         return [arg for arg in args
                 if targets.get(arg).timestamp > self.timestamp]
 
     def output(self, *args, **kwargs):
+        """Writes the standard output of a command to the target, see
+        produce.  The output is also copied to log if given."""
+        log = kwargs.pop('log', None)
+        command = flatten_expand_list(args)
+        self.info(' '.join(command))
+        self.produce(args, lambda f: self._call(
+            command, capture=True, stdout=f, **kwargs), log=log)
+
+    def path(self, path):
+        if self._cwd is None:
+            return path
+        return os.path.join(self._cwd, path)
+
+    def prerequisites(self):
+        """Returns the names of the targets brought up to date before this
+        one, its dependencies followed by its order-only dependencies."""
+        return list(self.dependencies) + list(self.order_only)
+
+    def produce(self, args, write, log=None):
+        """Writes the target by calling write with a temporary file next to
+        it, which replaces the target only once write has succeeded.  args
+        is the command line that write is equivalent to, the target is
+        restored from the cache instead if it holds its output."""
+        self.record(args)
+        key = cache.key(self, args) if cache.enabled else None
         args = flatten_expand_list(args)
-        self.info(' '.join(args))
         try:
-            output = check_output(args, **kwargs)
-            with open(self.name, 'w') as f:
-                f.write(output)
+            with atomic_write(self.name) as f:
+                if key is not None and cache.restore(key, f.name,
+                                                     self.outputs):
+                    self.info('restored %s from cache', self.name)
+                    self.metric('cache_hits', 1)
+                    return
+                if key is not None:
+                    self.metric('cache_misses', 1)
+                try:
+                    if trace.enabled:
+                        with trace.subprocess(self, args):
+                            write(f)
+                    else:
+                        write(f)
+                finally:
+                    f.close()
+                    if log is not None:
+                        shutil.copyfile(f.name, self.path(log % variables))
         except subprocess.CalledProcessError as e:
             self.clean(recurse=False)
             self.error(e)
+        if key is not None:
+            cache.store(key, self.name, self.outputs)
 
     def rm_rf(self, *args):
         args = flatten_expand_list(args)
         for arg in args:
             self.info('rm -rf %s', arg)
-            shutil.rmtree(arg, ignore_errors=True)
+            shutil.rmtree(self.path(arg), ignore_errors=True)
+
+    def record(self, *args):
+        """Records a command line run by the action.  The target is rebuilt
+        when the action's code, the constants it uses or the variables used
+        in its command lines change, or when one of the files that scanners
+        find from the command lines' arguments does.  Command lines built
+        from anything else, such as the contents of files, are not
+        compared."""
+        if self._recording is None:
+            return
+        for arg in flatten(args):
+            self._recording['variables'].update(
+                re.findall(r'%\((\w+)\)', arg))
+        args = flatten_expand_list(args)
+        for arg in args:
+            path = self.path(arg)
+            for regexp, scanner in scanners.iteritems():
+                if regexp.search(arg) and os.path.isfile(path):
+                    self._recording['implicit'].update(scanner(path))
 
     def run(self, *args, **kwargs):
+        self.record(args)
         args = flatten_expand_list(args)
         self.info(' '.join(args))
         try:
-            subprocess.check_call(args, **kwargs)
+            self.call(args, **kwargs)
         except subprocess.CalledProcessError as e:
             self.clean(recurse=False)
             self.error(e)
 
+    def sign(self):
+        if not self.phony:
+            digest = database.digest(self.name)
+            if digest is not None:
+                return digest
+        # targets without a file of their own are signed by their inputs
+        sha1 = hashlib.sha1()
+        for dependency in self.dependencies:
+            sha1.update('%s\0%s\0' % (
+                dependency, targets.get(dependency).signature))
+        return sha1.hexdigest()
+
+    def stale(self, timestamp):
+        """Returns why the target needs to be rebuilt, or None.  A target
+        rebuilt because one of its dependencies is rebuilt gives the chain of
+        reasons back to the first target."""
+        if self.timestamp == -1:
+            return 'phony' if self.phony else 'missing'
+        record = database.targets.get(self.name, {})
+        if self.action and 'command' in record:
+            if record['command'] != self.command(record['variables']):
+                return 'changed command, the action, its constants or one ' \
+                    'of the variables %s' % (
+                        ', '.join(record['variables']) or '-',)
+        for path, digest in sorted(record.get('implicit', {}).iteritems()):
+            current = database.digest(path)
+            if current != digest:
+                return 'changed implicit dependency %s (sha1 %s, was %s)' % (
+                    path, (current or 'missing')[:12], (digest or '-')[:12])
+        if database.signatures and self.action:
+            if 'inputs' not in record:
+                return 'no recorded signature'
+            output = database.digest(self.name)
+            if record.get('output') != output:
+                return 'output changed (sha1 %s, was %s)' % (
+                    (output or 'missing')[:12],
+                    (record.get('output') or '-')[:12])
+            inputs = record.get('inputs', {})
+            for name in self.dependencies:
+                dependency = targets.get(name)
+                if dependency.signature != inputs.get(name):
+                    if dependency._stale:
+                        return 'dependency %s is rebuilt, because %s' % (
+                            name, dependency._stale)
+                    return 'changed dependency %s (signature %s, was %s)' % (
+                        name, (dependency.signature or '-')[:12],
+                        (inputs.get(name) or '-')[:12])
+            if len(inputs) != len(set(self.dependencies)):
+                return 'removed dependencies %s' % (', '.join(
+                    sorted(set(inputs) - set(self.dependencies))),)
+            return None
+        own = self.timestamp
+        if self.restat:
+            # an unchanged output keeps its old mtime, so compare against the
+            # inputs it was last found to be up to date with
+            restat = record.get('restat')
+            if restat and restat[0] == self.timestamp:
+                own = max(restat)
+        if own >= timestamp:
+            return None
+        for name in self.dependencies:
+            dependency = targets.get(name)
+            if dependency.timestamp > own:
+                if dependency._stale:
+                    return 'dependency %s is rebuilt, because %s' % (
+                        name, dependency._stale)
+                return 'newer dependency %s (mtime %s, target %s)' % (
+                    name, isotime(dependency.timestamp), isotime(own))
+        return 'newer dependencies'
+
     @contextlib.contextmanager
     def tempdir(self):
         tempdir = tempfile.mkdtemp()
@@ -226,6 +1282,73 @@ class Target(object):
             with open(self.name, 'w'):
                 pass
 
+    def update(self, timestamp, dry_run=False, explain=False):
+        self.debug('build')
+        if self.timestamp is None:
+            stat = None if self.phony else snapshot.stat(self.name)
+            self.timestamp = -1 if stat is None else stat[0]
+        stale = self._stale = self.stale(timestamp)
+        if stale and explain:
+            self.info('explain: %s', stale)
+        if stale:
+            self.debug('action')
+            previous = None
+            if self._makedirs and not dry_run:
+                self.makedirs(os.path.dirname(self.name))
+            if self.action:
+                if self.action.__doc__:
+                    self.info(self.action.__doc__)
+                if not dry_run:
+                    if self.restat and self.timestamp != -1:
+                        previous = (self.timestamp,
+                                    database.digest(self.name))
+                    self._recording = {'implicit': set(), 'metrics': [],
+                                       'variables': set()}
+                    start = time.time()
+                    run_hooks('pre-action', {'target': self.name,
+                                             'reason': stale, 'start': start})
+                    status = 'failed'
+                    try:
+                        self.action(self)
+                        status = 'ok'
+                    finally:
+                        end = time.time()
+                        # actions can write anywhere
+                        snapshot.clear()
+                        recording, self._recording = self._recording, None
+                        if trace.enabled:
+                            trace.action(self, stale, start, end)
+                        run_hooks('post-action', {
+                            'target': self.name, 'reason': stale,
+                            'start': start, 'duration': end - start,
+                            'status': status,
+                            'metrics': recording['metrics']})
+                    database.record(
+                        self.name,
+                        command=self.command(recording['variables']),
+                        duration=round(end - start, 3),
+                        implicit=dict((path, database.digest(path))
+                                      for path in recording['implicit']),
+                        variables=sorted(recording['variables']))
+            if previous and database.digest(self.name) == previous[1]:
+                self.debug('restat')
+                os.utime(self.name, (time.time(), previous[0]))
+                snapshot.invalidate(self.name)
+                # utime may round the mtime, so record the one actually set
+                self.timestamp = snapshot.stat(self.name)[0]
+                database.record(self.name, restat=[self.timestamp, timestamp])
+            else:
+                self.timestamp = timestamp or time.time()
+        if database.signatures:
+            if stale and dry_run:
+                self.signature = None
+            else:
+                self.signature = self.sign()
+            if stale and self.action and not dry_run:
+                database.record(self.name, inputs=self.inputs(),
+                                output=self.signature)
+        return self.timestamp
+
 
 class TargetCollection(object):
 
@@ -244,7 +1367,7 @@ class TargetCollection(object):
         if name in self.targets:
             return self.targets[name]
         target = None
-        for regexp, f in rules.iteritems():
+        for regexp, f in rules.candidates(name):
             match = regexp.search(name)
             if not match:
                 continue
@@ -257,20 +1380,543 @@ class TargetCollection(object):
         return target
 
 
+class Trace(object):
+    """Records the actions run by a build as Chrome trace events."""
+
+    def __init__(self):
+        self.durations = {}
+        self.enabled = False
+        self.events = []
+        self.start = time.time()
+        self._threads = {}
+        self._subprocess_durations = collections.defaultdict(float)
+
+    def action(self, target, reason, start, end):
+        subprocess_duration = self._subprocess_durations.pop(target, 0)
+        self.durations[target] = end - start
+        self.event(target.name, 'action', start, end, reason=reason,
+                   subprocess=round(subprocess_duration, 6))
+
+    def critical_path(self, roots, order):
+        """Returns the chain of dependent actions taking the longest."""
+        longest = {}
+        for target in order:
+            length, previous = 0, None
+            for dependency in unique(target.dependencies):
+                dependency = targets.get(dependency)
+                if longest[dependency][0] > length:
+                    length, previous = longest[dependency][0], dependency
+            longest[target] = (length + self.durations.get(target, 0),
+                               previous)
+        path = []
+        target = max(roots, key=lambda root: longest[root][0])
+        while target is not None:
+            if target in self.durations:
+                path.append(target)
+            target = longest[target][1]
+        path.reverse()
+        return path
+
+    def event(self, name, category, start, end, **kwargs):
+        thread = threading.current_thread()
+        tid = self._threads.setdefault(thread.ident, len(self._threads))
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'pid': os.getpid(),
+            'tid': tid,
+            'ts': int(1e6 * (start - self.start)),
+            'dur': int(1e6 * (end - start)),
+            'args': kwargs})
+
+    def report(self, roots, order):
+        path = self.critical_path(roots, order)
+        logger.info('critical path: %.3fs in %d actions',
+                    sum(self.durations[target] for target in path), len(path))
+        for target in path:
+            logger.info('%10.3fs %s', self.durations[target], target.name)
+
+    @contextlib.contextmanager
+    def subprocess(self, target, args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self._subprocess_durations[target] += end - start
+            self.event(os.path.basename(args[0]), 'subprocess', start, end,
+                       args=' '.join(args))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, f)
+
+
 class VariableCollection(object):
+    """Variables, which are expanded in command lines and paths with
+    '%(NAME)s'.  A Lazy value is only evaluated when it is first used."""
 
     def __init__(self, **kwargs):
         for key, value in kwargs.iteritems():
             setattr(self, key, value)
 
+    def __getattribute__(self, key):
+        value = object.__getattribute__(self, key)
+        if isinstance(value, Lazy):
+            value = value.function()
+            object.__setattr__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
     def __setattr__(self, key, value):
-        if not hasattr(self, key):
+        if key not in vars(self):
             object.__setattr__(self, key, value)
 
 
+class Watcher(object):
+    """Reports changes to files in the directories of a list of files, using
+    inotify where available and polling otherwise."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_MOVED = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths, interval=1):
+        self.directories = set(os.path.dirname(path) for path in paths)
+        self.interval = interval
+        self._fd = None
+        self._watches = {}
+        if sys.platform.startswith('linux'):
+            try:
+                self._inotify_init()
+            except (AttributeError, OSError) as e:
+                logger.debug('inotify is not available: %s', e)
+                self.close()
+        if self._fd is None:
+            self._state = self._poll()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def wait(self, delay=0.2):
+        """Waits for changes and returns the paths that were modified and the
+        paths that were created, removed or renamed, once no further change
+        happened for delay seconds."""
+        changed, moved = self._wait(None)
+        while True:
+            more_changed, more_moved = self._wait(delay)
+            if not more_changed and not more_moved:
+                return changed, moved
+            changed |= more_changed
+            moved |= more_moved
+
+    def _inotify_init(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            self._fd = None
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE |
+                self.IN_MOVED)
+        for directory in self.directories:
+            wd = libc.inotify_add_watch(self._fd, directory or '.', mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(),
+                              'cannot watch %s' % (directory,))
+            self._watches[wd] = directory
+
+    def _poll(self):
+        state = {}
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory or '.')
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    state[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return state
+
+    def _wait(self, timeout):
+        changed, moved = set(), set()
+        if self._fd is None:
+            start = time.time()
+            while not changed and not moved:
+                if timeout is not None and time.time() - start >= timeout:
+                    break
+                time.sleep(self.interval if timeout is None
+                           else min(self.interval, timeout))
+                state, self._state = self._state, self._poll()
+                moved = set(state) ^ set(self._state)
+                changed = set(path for path in self._state
+                              if state.get(path, self._state[path]) !=
+                              self._state[path])
+            return changed, moved
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed, moved
+        data = os.read(self._fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip('\0')
+            offset += 16 + length
+            if wd not in self._watches or not name:
+                continue
+            path = os.path.join(self._watches[wd], name)
+            if mask & self.IN_MOVED:
+                moved.add(path)
+            else:
+                changed.add(path)
+        return changed, moved
+
+
+class Worker(object):
+    """A worker process, possibly on another host, that runs the commands of
+    remote targets.  The files that a command reads are sent to the worker,
+    which keeps them by content, and the target's file is sent back.
+    Workers run any command that they are sent, so they only run requests
+    carrying their token, which is sent in clear, and refuse to listen on
+    other hosts than localhost without one."""
+
+    def __init__(self, address, capacity=1, token=None):
+        self.address = self.parse(address)
+        self.capacity = capacity
+        self.running = 0
+        self.token = token
+
+    def call(self, target, args, capture=False, cwd=None, stdout=None):
+        inputs = {}
+        for path in self.inputs(target, args, cwd):
+            inputs[path] = [database.digest(path), os.access(path, os.X_OK)]
+        request = {'args': args, 'capture': capture,
+                   'cwd': os.path.relpath(cwd or '.'), 'inputs': inputs,
+                   'outputs': [] if target.phony else
+                   [target.name] + list(target.outputs),
+                   'token': self.token}
+        output = []
+        try:
+            connection = socket.create_connection(self.address)
+            rfile = connection.makefile('rb')
+            wfile = connection.makefile('wb')
+            self.send(wfile, 'j', request)
+            wfile.flush()
+            kind, reply = self.receive(rfile)
+            if 'error' in reply:
+                target.error('worker %s:%d refused the request: %s' % (
+                    self.address + (reply['error'],)))
+            paths = dict((value[0], path)
+                         for path, value in inputs.iteritems())
+            for digest in reply['missing']:
+                self.send_file(wfile, paths[digest])
+            wfile.flush()
+            while True:
+                kind, payload = self.receive(rfile)
+                if kind == 'j':
+                    break
+                elif kind == 'o' and stdout is not None:
+                    stdout.write(payload)
+                elif kind == 'o' and capture:
+                    output.append(payload)
+                elif target._buffer is not None:
+                    target._buffer.append(payload)
+                else:
+                    (sys.stdout if kind == 'o' else sys.stderr).write(payload)
+            for path in payload['outputs']:
+                self.receive_file(rfile, path)
+                snapshot.invalidate(path)
+            connection.close()
+        except (EOFError, socket.error) as e:
+            target.error('worker %s:%d failed: %s' % (self.address + (e,)))
+        if payload['returncode']:
+            raise subprocess.CalledProcessError(payload['returncode'], args)
+        return ''.join(output) if capture and stdout is None else None
+
+    @classmethod
+    def execute(cls, rfile, wfile, root, token=None):
+        """Runs the command of a request in a sandbox holding its inputs."""
+        kind, request = cls.receive(rfile)
+        # digests are compared so that the time taken does not tell how much
+        # of the token is right
+        if token is not None and (
+                hashlib.sha1(request.get('token') or '').digest() !=
+                hashlib.sha1(token).digest()):
+            logger.warning('refused a request with a wrong token')
+            cls.send(wfile, 'j', {'error': 'wrong token'})
+            wfile.flush()
+            return
+        blobs = os.path.join(root, 'blobs')
+        missing = sorted(set(
+            digest for digest, executable in request['inputs'].itervalues()
+            if not os.path.exists(os.path.join(blobs, digest))))
+        cls.send(wfile, 'j', {'missing': missing})
+        wfile.flush()
+        for digest in missing:
+            cls.receive_file(rfile, os.path.join(blobs, digest), digest)
+        sandbox = tempfile.mkdtemp(dir=root)
+        try:
+            for path, (digest, executable) in request['inputs'].iteritems():
+                dest = os.path.join(sandbox, path)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if executable:
+                    shutil.copy(os.path.join(blobs, digest), dest)
+                    os.chmod(dest, 0755)
+                else:
+                    os.link(os.path.join(blobs, digest), dest)
+            for path in request['outputs'] + [request['cwd']]:
+                dirname = os.path.join(sandbox, os.path.dirname(path))
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+            logger.info(' '.join(request['args']))
+            try:
+                process = subprocess.Popen(
+                    request['args'], cwd=os.path.join(sandbox, request['cwd']),
+                    stdout=subprocess.PIPE,
+                    stderr=(subprocess.PIPE if request['capture']
+                            else subprocess.STDOUT))
+            except OSError as e:
+                cls.send(wfile, 'e', '%s: %s\n' % (request['args'][0], e))
+                cls.send(wfile, 'j', {'returncode': 127, 'outputs': []})
+                return
+            errors = []
+            if request['capture']:
+                thread = threading.Thread(
+                    target=lambda: errors.append(process.stderr.read()))
+                thread.start()
+            for chunk in iter(lambda: os.read(process.stdout.fileno(), 65536),
+                              ''):
+                cls.send(wfile, 'o', chunk)
+                wfile.flush()
+            process.wait()
+            if request['capture']:
+                thread.join()
+                cls.send(wfile, 'e', ''.join(errors))
+            outputs = [path for path in request['outputs']
+                       if path not in request['inputs'] and
+                       os.path.isfile(os.path.join(sandbox, path))]
+            cls.send(wfile, 'j', {'returncode': process.returncode,
+                                  'outputs': outputs})
+            for path in outputs:
+                cls.send_file(wfile, os.path.join(sandbox, path))
+            wfile.flush()
+        finally:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+    def inputs(self, target, args, cwd=None):
+        """Returns the files in the project that a command may read: the
+        target's dependencies, the implicit dependencies found by scanners,
+        the arguments naming files, relative to the command's working
+        directory cwd, and the target's additional inputs."""
+        paths = set(target.dependencies)
+        paths.update(os.path.relpath(os.path.join(cwd or '.', arg))
+                     for arg in args if not os.path.isabs(arg))
+        if target._recording is not None:
+            paths.update(target._recording['implicit'])
+        if target.remote is not True:
+            for path in flatten_expand_list(target.remote):
+                paths.update(ifind(path) if os.path.isdir(path) else (path,))
+        return sorted(path for path in paths
+                      if not os.path.isabs(path) and
+                      not os.path.normpath(path).startswith(os.pardir) and
+                      os.path.isfile(path))
+
+    @staticmethod
+    def parse(address):
+        host, _, port = address.rpartition(':')
+        return (host or 'localhost', int(port))
+
+    @staticmethod
+    def receive(f):
+        header = f.read(5)
+        if len(header) < 5:
+            raise EOFError('connection closed')
+        kind, length = struct.unpack('!cI', header)
+        payload = f.read(length)
+        if len(payload) < length:
+            raise EOFError('connection closed')
+        return kind, json.loads(payload) if kind == 'j' else payload
+
+    @classmethod
+    def receive_file(cls, f, path, digest=None):
+        """Receives a file into path, atomically, checking its digest if one
+        is given."""
+        sha1 = hashlib.sha1()
+        # stored files are shared by hard links and must not be changed
+        with atomic_write(path, None if digest is None else 0444) as tmp:
+            while True:
+                kind, chunk = cls.receive(f)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                tmp.write(chunk)
+            if digest is not None and sha1.hexdigest() != digest:
+                raise EOFError('corrupt transfer of %s' % (path,))
+
+    @staticmethod
+    def send(f, kind, payload):
+        if kind == 'j':
+            payload = json.dumps(payload)
+        f.write(struct.pack('!cI', kind, len(payload)))
+        f.write(payload)
+
+    @classmethod
+    def send_file(cls, f, path):
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(1 << 20), ''):
+                cls.send(f, 'b', chunk)
+        cls.send(f, 'b', '')
+
+    @classmethod
+    def serve(cls, address, path='~/.cache/pake/worker', token=None):
+        """Serves requests carrying token forever, keeping files under
+        path."""
+        import SocketServer
+        host = cls.parse(address)[0]
+        if token is None and not (host == 'localhost' or host == '::1' or
+                                  host.startswith('127.')):
+            raise PakeError('a worker listening on %s runs the commands of '
+                            'anyone who can connect, set PAKE_WORKER_TOKEN'
+                            % (host,))
+        root = os.path.expanduser(path)
+        if not os.path.isdir(os.path.join(root, 'blobs')):
+            os.makedirs(os.path.join(root, 'blobs'))
+
+        class Handler(SocketServer.StreamRequestHandler):
+
+            def handle(self):
+                try:
+                    cls.execute(self.rfile, self.wfile, root, token)
+                except (EOFError, socket.error) as e:
+                    logger.warning('request failed: %s', e)
+
+        server = SocketServer.ThreadingTCPServer(cls.parse(address), Handler)
+        server.daemon_threads = True
+        logger.info('worker listening on %s:%d', *server.server_address)
+        server.serve_forever()
+
+
+cache = Cache()
+database = Database()
+downloads = DownloadCache()
+hooks = collections.defaultdict(list)
+pools = {}
 targets = TargetCollection()
-rules = {}
+rules = RuleCollection()
+scanners = {}
+services = []
+snapshot = Snapshot()
+trace = Trace()
 variables = VariableCollection(**os.environ)
+workers = []
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode=None):
+    """Yields a temporary file next to path, which replaces path once the
+    block completes and is removed if it raises.  The file is given mode,
+    or the mode of newly created files rather than tempfile's."""
+    dirname, basename = os.path.split(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    f = tempfile.NamedTemporaryFile(dir=dirname or '.',
+                                    prefix='.%s.' % (basename,), delete=False)
+    try:
+        with f:
+            yield f
+        os.chmod(f.name, 0666 & ~_umask if mode is None else mode)
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.remove(path)
+        os.rename(f.name, path)
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+
+def constant(value):
+    """Returns a representation of value if it is a string, a number or a
+    list, tuple, set or dict of them, otherwise None.  Strings are represented
+    the same whether they are str or unicode."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return repr(value)
+    if isinstance(value, dict):
+        items = [constant(item) for item in sorted(value.iteritems())]
+    elif isinstance(value, (set, frozenset)):
+        items = [constant(item) for item in sorted(value)]
+    elif isinstance(value, (list, tuple)):
+        items = [constant(item) for item in value]
+    else:
+        return None
+    if None in items:
+        return None
+    return '%s(%s)' % (type(value).__name__, ', '.join(items))
+
+
+def fingerprint(function):
+    """Returns a digest of a function's code, including the code of the
+    functions and the values of the constants of its module that it refers
+    to, such as lists of command line arguments, so that editing an action,
+    a helper it calls or the data they use can be detected."""
+    sha1 = hashlib.sha1()
+    functions, seen = [function], set([function])
+    while functions:
+        function = functions.pop()
+        for cell in function.func_closure or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue
+            representation = constant(value)
+            if representation is not None:
+                sha1.update(representation)
+            elif isinstance(value, types.FunctionType) and value not in seen:
+                seen.add(value)
+                functions.append(value)
+        codes = [function.func_code]
+        while codes:
+            code = codes.pop()
+            sha1.update(code.co_code)
+            for const in code.co_consts:
+                if isinstance(const, types.CodeType):
+                    codes.append(const)
+                else:
+                    sha1.update(repr(const))
+            for name in code.co_names:
+                value = function.func_globals.get(name)
+                representation = constant(value)
+                if representation is not None:
+                    sha1.update('%s=%s' % (name, representation))
+                elif (isinstance(value, types.FunctionType) and
+                        value.__module__ == function.__module__ and
+                        value not in seen):
+                    seen.add(value)
+                    functions.append(value)
+    return sha1.hexdigest()
 
 
 def flatten(*args):
@@ -284,41 +1930,124 @@ def flatten(*args):
 
 
 def flatten_expand_list(*args):
-    return list(arg % vars(variables) for arg in flatten(args))
+    return list(arg % variables for arg in flatten(args))
+
+
+def hook(event):
+    """Registers a function called with a dict describing each event, which
+    is one of pre-action, post-action or build-finished.  Action hooks are
+    called from the threads running the actions."""
+    def f(function):
+        hooks[event].append(function)
+        return function
+    return f
 
 
 def ifind(*paths):
     for path in paths:
-        for dirpath, dirnames, names in os.walk(path):
-            for name in names:
-                if sys.platform == 'win32':
-                    yield '/'.join(dirpath.split('\\') + [name])
-                else:
-                    yield os.path.join(dirpath, name)
+        try:
+            dirnames, names = snapshot.listdir(path)
+        except OSError:
+            continue
+        for name in names:
+            if sys.platform == 'win32':
+                yield '/'.join(path.split('\\') + [name])
+            else:
+                yield os.path.join(path, name)
+        for dirname in dirnames:
+            for name in ifind(os.path.join(path, dirname)):
+                yield name
+
+
+def isotime(timestamp):
+    return '%s.%06d' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(timestamp)),
+                        int(timestamp % 1 * 1e6))
+
+
+def literal_prefix(regexp):
+    """Returns the literal string that every match of regexp starts with, or
+    the empty string if matches are not anchored at the start."""
+    if regexp.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+    items = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    anchors = (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING)
+    if (not items or items[0][0] != sre_constants.AT or
+            items[0][1] not in anchors):
+        return ''
+    prefix = []
+    for op, arg in items[1:]:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(unichr(arg) if arg > 127 else chr(arg))
+    return ''.join(prefix)
 
 
 def main(argv=sys.argv):
     option_parser = optparse.OptionParser()
     option_parser.add_option('-c', '--clean',
                              action='store_true')
+    option_parser.add_option('--cache',
+                             action='store_true')
+    option_parser.add_option('--cache-dir',
+                             metavar='DIR')
+    option_parser.add_option('--cache-size',
+                             metavar='MB', type='int')
+    option_parser.add_option('--download-dir',
+                             metavar='DIR')
+    option_parser.add_option('--download-mirror',
+                             action='append', default=[],
+                             metavar='DIR|URL')
+    option_parser.add_option('--explain',
+                             action='store_true')
     option_parser.add_option('-g', '--graph',
                              action='store_true')
+    option_parser.add_option('-j', '--jobs',
+                             type='int')
+    option_parser.add_option('-k', '--keep-going',
+                             action='store_true')
+    option_parser.add_option('-l', '--load-average', '--max-load',
+                             type='float')
+    option_parser.add_option('--metrics',
+                             metavar='FILE')
     option_parser.add_option('-n', '--dry-run', '--just-print', '--recon',
                              action='store_true')
     option_parser.add_option('-r', '--really',
                              action='store_true')
+    option_parser.add_option('--resource',
+                             action='append', default=[],
+                             metavar='POOL=AMOUNT')
+    option_parser.add_option('--serve-worker',
+                             metavar='[HOST:]PORT')
+    option_parser.add_option('--signatures',
+                             action='store_true')
+    option_parser.add_option('--trace',
+                             metavar='FILE')
     option_parser.add_option('-v', '--verbose',
                              action='count', dest='logging_level')
+    option_parser.add_option('-w', '--watch',
+                             action='store_true')
+    option_parser.add_option('--worker',
+                             action='append', default=[],
+                             metavar='[HOST:]PORT[=CAPACITY]')
     option_parser.set_defaults(logging_level=0)
     options, args = option_parser.parse_args(argv[1:])
     logging.basicConfig(format='%(asctime)s %(name)s: %(message)s',
                         level=logging.INFO - 10 * options.logging_level)
+    token = os.environ.get('PAKE_WORKER_TOKEN')
+    if options.serve_worker:
+        try:
+            Worker.serve(options.serve_worker, token=token)
+        except PakeError as e:
+            logger.error(e)
+            sys.exit(1)
+        return
     targets_ = []
     for arg in args:
         match = re.match(r'(?P<key>\w+)=(?P<value>.*)\Z', arg)
         if match:
             key, value = match.group('key', 'value')
-            if not hasattr(variables, key):
+            if key not in vars(variables):
                 logger.error('%s is not a variable', key)
             logger.debug('%s=%r', key, value)
             object.__setattr__(variables, key, value)
@@ -326,20 +2055,83 @@ def main(argv=sys.argv):
         targets_.append(arg)
     if not targets_:
         targets_ = (targets.default.name,)
+    cache.enabled = options.cache
+    if options.cache_dir:
+        cache.path = options.cache_dir
+    if options.cache_size is not None:
+        cache.size = options.cache_size * 1024 * 1024
+    if options.download_dir:
+        downloads.path = options.download_dir
+    downloads.mirrors.extend(options.download_mirror)
+    database.signatures = options.signatures
+    database.load()
+    trace.enabled = bool(options.trace)
+
+    if 'mem' not in pools and hasattr(os, 'sysconf'):
+        try:
+            pools['mem'] = (os.sysconf('SC_PAGE_SIZE') *
+                            os.sysconf('SC_PHYS_PAGES'))
+        except (OSError, ValueError):
+            pass
+    for resource in options.resource:
+        pool, _, amount = resource.partition('=')
+        pools[pool] = quantity(amount)
+    # an explicit -j overrides the jobserver of a parent make, as in make
+    jobserver = None
+    if options.jobs is None and os.name == 'posix':
+        jobserver = Jobserver.from_environ()
+    if jobserver is not None:
+        import multiprocessing
+        options.jobs = jobserver.jobs or multiprocessing.cpu_count()
+    elif options.jobs > 1 and os.name == 'posix':
+        jobserver = Jobserver.create(options.jobs)
+    for worker in options.worker:
+        address, _, capacity = worker.partition('=')
+        workers.append(Worker(address, int(capacity or 1), token))
+    scheduler = Scheduler(jobs=options.jobs or 1, dry_run=options.dry_run,
+                          explain=options.explain, jobserver=jobserver,
+                          keep_going=options.keep_going,
+                          load=options.load_average, pools=pools,
+                          workers=workers)
+    if options.metrics:
+        MetricsExporter(options.metrics)
+    order = None
+    start = time.time()
+    status = 'failed'
     try:
-        for target in targets_:
-            target = targets.get(target)
-            if options.clean:
-                target.clean(really=options.really, recurse=True)
-            elif options.graph:
-                sys.stdout.write('digraph "%s" {\n' % (target.name,))
-                target.graph(sys.stdout, set())
-                sys.stdout.write('}\n')
-            else:
-                target.build(dry_run=options.dry_run)
-    except BuildError as e:
+        roots = map(targets.get, targets_)
+        # every operation visits each target reachable from the requested
+        # ones exactly once, in this order
+        order = toposort(roots)
+        if options.clean:
+            for target in order:
+                target.clean(really=options.really, recurse=False)
+        elif options.graph:
+            sys.stdout.write('digraph "%s" {\n' % (' '.join(targets_),))
+            for target in order:
+                target.graph(sys.stdout)
+            sys.stdout.write('}\n')
+        elif options.watch:
+            watch(roots, order, scheduler)
+        else:
+            scheduler.build(order)
+        status = 'ok'
+    except (BuildError, BuildErrors) as e:
         logger.error(e)
         sys.exit(1)
+    finally:
+        if not options.clean and not options.graph:
+            run_hooks('build-finished', {
+                'targets': list(targets_), 'start': start,
+                'duration': time.time() - start, 'status': status})
+        for service in services:
+            service.stop()
+        if cache.enabled:
+            cache.evict()
+        database.save()
+        if trace.enabled and order is not None:
+            trace.write(options.trace)
+            trace.report(roots, order)
 
 
 def output(*args):
@@ -348,9 +2140,40 @@ def output(*args):
     return check_output(args)
 
 
+def quantity(amount):
+    """Returns amount, which may be a string with a K, M or G suffix, as a
+    number."""
+    if isinstance(amount, basestring):
+        match = re.match(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*\Z', amount,
+                         re.IGNORECASE)
+        if not match:
+            raise ValueError('invalid quantity %r' % (amount,))
+        exponent = ' KMG'.index(match.group(2).upper() or ' ')
+        amount = float(match.group(1)) * 1024 ** exponent
+    return int(amount)
+
+
 def rule(pattern):
     def f(targetmaker):
-        rules[re.compile(pattern)] = targetmaker
+        rules.add(pattern, targetmaker)
+    return f
+
+
+def run_hooks(event, data):
+    for function in hooks.get(event, ()):
+        try:
+            function(data)
+        except Exception:
+            logger.warning('%s hook %s failed', event, function.__name__,
+                           exc_info=True)
+
+
+def scanner(pattern):
+    """Registers a function returning the files that a command line argument
+    matching pattern implicitly depends on."""
+    def f(scanner):
+        scanners[re.compile(pattern)] = scanner
+        return scanner
     return f
 
 
@@ -362,12 +2185,85 @@ def target(name, *dependencies, **kwargs):
     return f
 
 
+def toposort(roots):
+    """Returns the targets reachable from roots, dependencies first."""
+    order = []
+    done = {}
+    for root in roots:
+        if root in done:
+            continue
+        done[root] = False
+        stack = [(root, iter(root.prerequisites()))]
+        while stack:
+            target, dependencies = stack[-1]
+            for dependency in dependencies:
+                dependency = targets.get(dependency)
+                if dependency not in done:
+                    done[dependency] = False
+                    stack.append((dependency,
+                                  iter(dependency.prerequisites())))
+                    break
+                if not done[dependency]:
+                    raise DependencyCycleError(dependency)
+            else:
+                stack.pop()
+                done[target] = True
+                order.append(target)
+    return order
+
+
+def unique(iterable):
+    seen = set()
+    for element in iterable:
+        if element not in seen:
+            seen.add(element)
+            yield element
+
+
 def virtual(name, *dependencies, **kwargs):
     target = Target(name, dependencies=dependencies, clean=False, phony=True,
                     **kwargs)
     targets.add(target)
 
 
+def watch(roots, order, scheduler):
+    """Builds roots, then rebuilds them whenever one of the source files they
+    depend on changes.  Adding or removing a source file can change the
+    graph itself, so pake restarts to load it again."""
+    sources = [target.name for target in order
+               if target.action is None and not target.phony]
+    watcher = Watcher(sources)
+    while True:
+        try:
+            scheduler.build(order)
+        except BuildError as e:
+            logger.error(e)
+            e.target.timestamp = None
+        except BuildErrors as e:
+            logger.error(e)
+            for error in e.errors:
+                error.target.timestamp = None
+        database.save()
+        logger.info('watching %d files for changes', len(sources))
+        changed, moved = watcher.wait()
+        for path in moved:
+            name = os.path.basename(path)
+            if name.startswith(('.', '#')) or name.endswith('~'):
+                continue
+            if (path in targets.targets) != os.path.exists(path):
+                logger.info('%s was added or removed, restarting', path)
+                watcher.close()
+                for service in services:
+                    service.stop()
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+        for path in changed | moved:
+            snapshot.invalidate(path)
+            target = targets.targets.get(path)
+            if target is not None and target.action is None:
+                target.debug('changed')
+                target.timestamp = None
+
+
 def which(program):
     """Returns the full path of a given argument or `None`.
     See: http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python"""